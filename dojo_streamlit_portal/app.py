@@ -1,15 +1,36 @@
 import streamlit as st
 import pandas as pd
 import gspread
+from gspread.utils import rowcol_to_a1
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import bcrypt
+import functools
 import hashlib
-import pytz
+import hmac
+import html
 import random
+import re
 import resend
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 
 
+# --- Styling ---
+_CSS = """
+    <style>
+    .metric-label { font-weight:600; }
+    .muted { color:#6b7280; font-size:0.9rem; }
+    </style>
+"""
+
 st.set_page_config(page_title="Dojo Member Portal", page_icon="🥋")
+st.markdown(_CSS, unsafe_allow_html=True)
 
 if "member" not in st.session_state:
     st.session_state.member = None
@@ -35,54 +56,356 @@ if "reset_cooldown_until" not in st.session_state:
 if "code_sent" not in st.session_state:
     st.session_state.code_sent = False
 
-# --- Styling ---
-st.markdown("""
-    <style>
-    .metric-label { font-weight:600; }
-    </style>
-""", unsafe_allow_html=True)
+if "myreq_loaded" not in st.session_state:
+    st.session_state.myreq_loaded = False
+
+if "students_by_name" not in st.session_state:
+    st.session_state.students_by_name = {}
 
 # --- Config / Secrets ---
+SYDNEY_TZ = ZoneInfo("Australia/Sydney")
+PHONE_NON_DIGIT = re.compile(r"\D")
+# Only needed to check legacy SHA-256 PIN_Hash values; bcrypt hashes carry their own salt
+PIN_SALT = st.secrets.get("security", {}).get("pin_salt", "").encode()
+BCRYPT_ROUNDS = 12
+# Request statuses that count as still pending
+PENDING_STATUSES = frozenset({"new","pending","in review","in-progress","submitted"})
+
+# Formats the portal writes to the Requests sheet (append_requests still uses the legacy ISO stamp)
+DATE_FMT = "%d-%m-%Y"
+TS_FMT = "%d-%m-%Y %H:%M:%S"
+LEGACY_TS_FMT = "%Y-%m-%d %H:%M:%S"
+ADMIN_EMAILS = {str(e).strip().casefold() for e in st.secrets.get("admin", {}).get("emails", [])}
+
+@st.cache_resource
 def get_gsheets_client():
     scopes = ["https://www.googleapis.com/auth/spreadsheets"]
     info = st.secrets["google_service_account"]
     creds = Credentials.from_service_account_info(info, scopes=scopes)
-    return gspread.authorize(creds)
+    # One pooled keep-alive session, so repeat Sheets calls skip the TCP/TLS handshake
+    session = AuthorizedSession(creds)
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=10))
+    return gspread.Client(auth=creds, session=session)
+
+# Resolved worksheet handles; opening a spreadsheet costs a metadata round trip
+@st.cache_resource
+def get_members_ws():
+    return get_gsheets_client().open_by_key(st.secrets["sheets"]["members_sheet_key"]).sheet1
+
+@st.cache_resource
+def get_requests_ws():
+    return get_gsheets_client().open_by_key(st.secrets["sheets"]["requests_sheet_key"]).sheet1
+
+@st.cache_data(ttl=60*60)
+def get_requests_headers():
+    """Header row of the Requests sheet; it only changes when an admin edits the sheet."""
+    return get_requests_ws().row_values(1)
+
+def norm_key(x) -> str:
+    """Match key for emails, IDs and sheet labels: trimmed and case-folded."""
+    return str(x).strip().casefold()
+
+def get_columns(ws, columns, headers=None):
+    """Fetch only the named columns of a worksheet (one batch_get, plus a header read
+    unless headers are passed in). Returns {header: [values...]} padded to equal length."""
+    if headers is None:
+        headers = ws.row_values(1)
+    present = [c for c in columns if c in headers]
+    if not present:
+        return {}
+    ranges = []
+    for c in present:
+        letter = rowcol_to_a1(1, headers.index(c) + 1)[:-1]
+        ranges.append(f"{letter}2:{letter}")
+    fetched = ws.batch_get(ranges, major_dimension="COLUMNS")
+    data = {c: (list(vr[0]) if vr else []) for c, vr in zip(present, fetched)}
+    n = max(len(v) for v in data.values())
+    return {c: v + [""] * (n - len(v)) for c, v in data.items()}
+
+def get_columns_df(ws, columns, headers=None):
+    """get_columns as a DataFrame, without rows that are blank in every fetched column."""
+    df = pd.DataFrame(get_columns(ws, columns, headers))
+    return df[df.ne("").any(axis=1)] if not df.empty else df
+
+def get_matching_rows_df(ws, columns, key_col, key, headers=None):
+    """Rows whose key_col matches key (trimmed, case-insensitive), named columns only.
+    Reads the key column, then batch_gets just the matching row ranges."""
+    if headers is None:
+        headers = ws.row_values(1)
+    present = [c for c in columns if c in headers]
+    if key_col not in headers:
+        return pd.DataFrame(columns=present)
+    keys = get_columns(ws, [key_col], headers)[key_col]
+    row_ids = [i for i, v in enumerate(keys, start=2) if norm_key(v) == key]
+    if not row_ids:
+        return pd.DataFrame(columns=present)
+
+    # Merge consecutive rows into one range each
+    runs = []
+    for r in row_ids:
+        if runs and runs[-1][1] == r - 1:
+            runs[-1][1] = r
+        else:
+            runs.append([r, r])
+    last = rowcol_to_a1(1, len(headers))[:-1]
+    fetched = ws.batch_get([f"A{a}:{last}{b}" for a, b in runs])
+    rows = [list(row) + [""] * (len(headers) - len(row)) for vr in fetched for row in vr]
+    return pd.DataFrame(rows, columns=headers)[present]
+
+# Members columns the portal reads (PIN or PIN_Hash may be absent)
+MEMBER_COLS = [
+    "MemberID","MemberName","Email","LeaveYear","AnnualAllowance","LeaveTaken",
+    "LeaveBalance","LastUpdated","PIN","PIN_Hash",
+]
+
+# Requests columns read by the "My requests" tab
+REQUESTS_COLS = [
+    "Timestamp","MemberEmail","MemberID","RequestType","Message","Status","AdminNotes",
+    "FromDate","ToDate","Weeks","LeaveReason","LeaveDescription",
+    "UpdateType","UpdateName","UpdatePhone","UpdateEmail","Addr1","Addr2","Suburb","PostCode",
+]
+
+# The subset the leave overlap check needs (match keys, period, and what the conflict table shows)
+LEAVE_COLS = ["MemberEmail","MemberID","RequestType","FromDate","ToDate","Weeks","Status"]
+
+def parse_sheet_dates(values, *formats):
+    """Parse with each fixed format in turn (pandas' C fast path, no dateutil guessing).
+    Values matching none of them become NaT."""
+    out = pd.to_datetime(values, errors="coerce", format=formats[0])
+    for fmt in formats[1:]:
+        missing = out.isna()
+        if not missing.any():
+            break
+        out = out.fillna(pd.to_datetime(values[missing], errors="coerce", format=fmt))
+    return out
+
+@st.cache_resource(ttl=24*60*60)
+def load_members_index():
+    """(columns, {normalised email: [member records]}, verify) — an account may hold several
+    students. verify(pin, rec) is chosen once for the sheet's PIN schema (None without one).
+    Shared across sessions — treat as read-only."""
+    ws = get_members_ws()
+    cols = get_columns(ws, MEMBER_COLS)
+    by_email = {}
+    for values in zip(*cols.values()):
+        rec = dict(zip(cols, values))
+        for k in MEMBER_NUMERIC_FIELDS:
+            if k in rec:
+                rec[k] = as_float(rec[k])
+        by_email.setdefault(norm_key(rec.get("Email", "")), []).append(rec)
+    if "PIN_Hash" in cols:
+        verify = _verify_mixed if "PIN" in cols else _verify_hashed
+    elif "PIN" in cols:
+        verify = _verify_plain
+    else:
+        verify = None  # no PIN column: login refuses rather than letting anyone in
+    return list(cols), by_email, verify
+
+def members_for_email(by_email, email):
+    return by_email.get(norm_key(email or ""), [])
 
-@st.cache_data(ttl=60)
-def load_members_df():
-    gc = get_gsheets_client()
-    ws = gc.open_by_key(st.secrets["sheets"]["members_sheet_key"]).sheet1
-    return pd.DataFrame(ws.get_all_records())
+# Member fields the logged-in view reads; only these are kept in session_state
+MEMBER_SESSION_FIELDS = ("MemberID","MemberName","Email","LeaveYear","AnnualAllowance","LeaveTaken","LeaveBalance","LastUpdated")
+
+# Numeric leave fields, coerced to float once per directory load
+MEMBER_NUMERIC_FIELDS = ("AnnualAllowance","LeaveTaken","LeaveBalance")
+
+def as_float(x, default=0.0):
+    try:
+        return float(x)
+    except Exception:
+        return default
+
+def member_session_record(row) -> dict:
+    rec = {k: row.get(k, "") for k in MEMBER_SESSION_FIELDS}
+    for k in MEMBER_NUMERIC_FIELDS:
+        if not isinstance(rec[k], float):
+            rec[k] = 0.0  # column missing from the sheet
+    return rec
+
+def _add_request_keys(df):
+    """Normalised match keys and parsed leave dates, computed once per Requests fetch."""
+    keys = {}
+    for src, dst in (("MemberEmail", "_email_norm"), ("MemberID", "_memberid_norm"), ("RequestType", "_rt_norm")):
+        if src in df.columns:
+            keys[dst] = df[src].astype(str).str.strip().str.casefold()
+    for src, dst in (("FromDate", "_from"), ("ToDate", "_to")):
+        if src in df.columns:
+            keys[dst] = parse_sheet_dates(df[src], DATE_FMT)
+    return df.assign(**keys)
+
+@st.cache_data(ttl=30, show_spinner=False)
+def load_requests_df():
+    """Requests sheet (LEAVE_COLS only, plus _add_request_keys), for the leave overlap check."""
+    return _add_request_keys(get_columns_df(get_requests_ws(), LEAVE_COLS, get_requests_headers()))
+
+@st.cache_data(ttl=30, show_spinner=False)
+def load_my_requests(email_key: str, member_id: str):
+    """This member's rows from the Requests sheet, cached briefly per member.
+    Only rows whose MemberEmail matches are downloaded."""
+    mine = get_matching_rows_df(get_requests_ws(), REQUESTS_COLS, "MemberEmail", email_key, get_requests_headers())
+    if "MemberID" not in mine.columns:
+        return mine.iloc[0:0]
+    mine = mine[mine["MemberID"].astype(str).str.strip().str.casefold() == member_id]
+    # Normalised type, pending flag, parsed dates and newest-first sort: once per fetch, not per rerun
+    mine = mine.assign(
+        _rt=mine["RequestType"].astype(str).str.strip().str.casefold() if "RequestType" in mine.columns else "",
+        _pending=mine["Status"].astype(str).str.strip().str.casefold().isin(PENDING_STATUSES) if "Status" in mine.columns else False,
+    )
+    for src, dst, formats in (("FromDate", "_from", (DATE_FMT,)),
+                              ("ToDate", "_to", (DATE_FMT,)),
+                              ("Timestamp", "_ts", (TS_FMT, LEGACY_TS_FMT))):
+        if src in mine.columns:
+            mine = mine.assign(**{dst: parse_sheet_dates(mine[src], *formats)})
+    if "_ts" in mine.columns:
+        mine = mine.sort_values("_ts", ascending=False, kind="stable")
+    return mine
+
+@st.cache_data(ttl=30, show_spinner=False)
+def load_leave_periods(email_key: str, member_id: str):
+    """This member's leave requests with parsed _from/_to dates; rows without a valid
+    FromDate/ToDate period are dropped."""
+    df = load_requests_df()
+    if not {"_email_norm","_from","_to"}.issubset(df.columns):
+        return pd.DataFrame(columns=[*df.columns, "_from", "_to"])
+    mask = (df["_email_norm"] == email_key) & df["_from"].notna() & df["_to"].notna() & (df["_from"] <= df["_to"])
+    if "_memberid_norm" in df.columns:
+        mask &= df["_memberid_norm"] == member_id
+    if "_rt_norm" in df.columns:
+        mask &= df["_rt_norm"] == "leave request"
+    return df[mask]
+
+def leave_periods(email_key: str, member_id: str, use_my_requests: bool):
+    """Leave periods for the overlap check. With use_my_requests (the session has loaded the
+    My requests tab) they come from that per-member read, usually still cached; otherwise from
+    the shared Requests read."""
+    if use_my_requests:
+        mine = load_my_requests(email_key, member_id)
+        if {"_from","_to"}.issubset(mine.columns):
+            return mine[(mine["_rt"] == "leave request") & mine["_from"].notna() & mine["_to"].notna()
+                        & (mine["_from"] <= mine["_to"])]
+    return load_leave_periods(email_key, member_id)
+
+def overlapping_leave(periods, start, end):
+    """Rows of periods whose inclusive [_from, _to] overlaps [start, end]."""
+    if periods.empty:
+        return periods
+    intervals = pd.IntervalIndex.from_arrays(periods["_from"], periods["_to"], closed="both")
+    new = pd.Interval(pd.Timestamp(start), pd.Timestamp(end), closed="both")
+    return periods[intervals.overlaps(new)]
+
+@st.cache_resource
+def _io_pool():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="dojo-io")
+
+def _warm_leave_periods(ctx, email_key, member_id, use_my_requests):
+    # Runs on a pool thread; attach the session's context so the st caches are shared,
+    # and put back whatever the thread had so later tasks don't inherit this session.
+    thread = threading.current_thread()
+    previous = get_script_run_ctx(suppress_warning=True)
+    add_script_run_ctx(thread, ctx)
+    try:
+        leave_periods(email_key, member_id, use_my_requests)
+    except Exception:
+        pass  # the submit path reads again and reports the error
+    finally:
+        add_script_run_ctx(thread, previous)
+
+def prefetch_leave_periods(email_key, member_id):
+    """Start warming leave_periods in the background; returns the future."""
+    fut = st.session_state.get("lr_prefetch")
+    if fut is None or fut.done():
+        fut = _io_pool().submit(_warm_leave_periods, get_script_run_ctx(), email_key, member_id,
+                                st.session_state.myreq_loaded)
+        st.session_state.lr_prefetch = fut
+    return fut
+
+def clear_requests_cache():
+    """Drop cached Requests reads so the next load sees rows just written."""
+    load_requests_df.clear()
+    load_my_requests.clear()
+    load_leave_periods.clear()
+
+@st.cache_resource
+def _pin_hasher():
+    """SHA-256 state primed with the salt; legacy_pin_hash works on copies of it."""
+    h = hashlib.sha256()
+    h.update(PIN_SALT)
+    return h
+
+def legacy_pin_hash(raw_pin: str) -> str:
+    """Salted SHA-256, as written by utils/hash_pins.py. Verify-only."""
+    h = _pin_hasher().copy()
+    h.update(str(raw_pin).encode())
+    return h.hexdigest()
 
 def pin_hash(raw_pin: str) -> str:
-    salt = st.secrets.get("security", {}).get("pin_salt", "")
-    return hashlib.sha256((salt + str(raw_pin)).encode()).hexdigest()
-
-def find_member(df, email, pin):
-    email = (email or "").strip().lower()
-    if not email: return None
-    row = df[df["Email"].str.strip().str.lower() == email]
-    if row.empty: return None
-    r = row.iloc[0]
-    # Prefer hashed PIN if available
-    if "PIN_Hash" in row.columns and str(r.get("PIN_Hash","")).strip():
-        if pin_hash(pin) != str(r["PIN_Hash"]).strip():
-            return None
-    elif "PIN" in row.columns:
-        if (pin or "").strip() != str(r["PIN"]).strip():
-            return None
-    else:
-        # If no PIN column, treat as open (not recommended)
-        pass
-    return r
+    """bcrypt hash (modular-crypt string, per-hash salt) for storing in PIN_Hash."""
+    return bcrypt.hashpw(str(raw_pin).encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
 
-def append_request(member, req_type, message):
-    tz = pytz.timezone("Australia/Sydney")
-    ts = datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
-    gc = get_gsheets_client()
-    ws = gc.open_by_key(st.secrets["sheets"]["requests_sheet_key"]).sheet1
-    ws.append_row([
+def is_bcrypt_hash(stored: str) -> bool:
+    return stored.startswith(("$2a$", "$2b$", "$2y$"))
+
+def verify_pin(raw_pin: str, stored: str) -> bool:
+    stored = str(stored).strip()
+    if is_bcrypt_hash(stored):
+        try:
+            return bcrypt.checkpw(str(raw_pin).encode(), stored.encode())
+        except ValueError:
+            return False  # malformed hash in the sheet
+    return hmac.compare_digest(legacy_pin_hash(raw_pin), stored)
+
+def needs_rehash(rec) -> bool:
+    """True for rows that still verify against a legacy SHA-256 hash or a plain PIN."""
+    return "PIN_Hash" in rec and not is_bcrypt_hash(str(rec.get("PIN_Hash","")).strip())
+
+def _verify_hashed(pin, rec):
+    return verify_pin(pin, rec.get("PIN_Hash",""))
+
+def _verify_plain(pin, rec):
+    return hmac.compare_digest((pin or "").strip().encode(), str(rec.get("PIN","")).strip().encode())
+
+def _verify_mixed(pin, rec):
+    # Mid-migration sheets: prefer the hash where a row has one
+    if str(rec.get("PIN_Hash","")).strip():
+        return _verify_hashed(pin, rec)
+    return _verify_plain(pin, rec)
+
+@st.cache_resource
+def _requests_write_queue():
+    """Shared across sessions: submits waiting to be appended, and the lock held by the writer."""
+    return {"pending": deque(), "lock": threading.Lock()}
+
+def write_requests_rows(rows):
+    """Append rows to the Requests sheet. Submits from other sessions that arrive while an
+    append is in flight are written together by the next writer, in one values.append."""
+    q = _requests_write_queue()
+    job = {"rows": rows, "done": threading.Event(), "error": None}
+    q["pending"].append(job)
+    with q["lock"]:
+        if not job["done"].is_set():
+            batch = []
+            while q["pending"]:
+                batch.append(q["pending"].popleft())
+            try:
+                # table_range pins the append to the table anchored at A1
+                get_requests_ws().append_rows([r for j in batch for r in j["rows"]],
+                                              value_input_option="RAW", insert_data_option="INSERT_ROWS",
+                                              table_range="A1")
+            except Exception as e:
+                for j in batch:
+                    j["error"] = e
+            finally:
+                for j in batch:
+                    j["done"].set()
+    if job["error"] is not None:
+        raise job["error"]
+    clear_requests_cache()
+
+def append_requests(member, items):
+    """Append several (req_type, message) requests in a single Sheets call."""
+    ts = datetime.now(SYDNEY_TZ).strftime(LEGACY_TS_FMT)
+    rows = [[
         ts,
         member.get("Email",""),
         member.get("MemberID",""),
@@ -91,23 +414,41 @@ def append_request(member, req_type, message):
         "New",
         "",
         ""
-    ])
+    ] for req_type, message in items]
+    if not rows:
+        return
+    write_requests_rows(rows)
+
+def append_request(member, req_type, message):
+    append_requests(member, [(req_type, message)])
+
+@functools.lru_cache(maxsize=4)
+def header_index(headers: tuple) -> dict:
+    """{header: position}; the Requests header row rarely changes, so this is built once."""
+    return {h: i for i, h in enumerate(headers)}
+
+def row_in_header_order(headers, fields):
+    """A row laid out like headers, with fields placed by column name (unknown names dropped)."""
+    idx = header_index(tuple(headers))
+    row = [""] * len(headers)
+    for name, value in fields.items():
+        i = idx.get(name)
+        if i is not None:
+            row[i] = value
+    return row
 
 def append_leave_request(member: dict, start_monday, weeks: int, reason="Personal", description=""):
     """Append a weekly leave request (start on Monday, minimum 1 week). Falls back to Message if columns missing."""
-    tz = pytz.timezone("Australia/Sydney")
-    ts = datetime.now(tz).strftime("%d-%m-%Y %H:%M:%S")  # 👈 timestamp in DD-MM-YYYY
-    gc = get_gsheets_client()
-    ws = gc.open_by_key(st.secrets["sheets"]["requests_sheet_key"]).sheet1
+    ts = datetime.now(SYDNEY_TZ).strftime(TS_FMT)  # 👈 timestamp in DD-MM-YYYY
 
     start_monday = pd.to_datetime(start_monday).date()
-    end_date = (start_monday + pd.Timedelta(days=7 * weeks - 1)).date()
+    end_date = start_monday + timedelta(days=7 * weeks - 1)
 
     # Format dates as DD-MM-YYYY
-    start_s = start_monday.strftime("%d-%m-%Y")
-    end_s = end_date.strftime("%d-%m-%Y")
+    start_s = start_monday.strftime(DATE_FMT)
+    end_s = end_date.strftime(DATE_FMT)
 
-    headers = ws.row_values(1)
+    headers = get_requests_headers()
     have = {h: (h in headers) for h in ["StudentName","FromDate","ToDate","Weeks","LeaveReason","LeaveDescription"]}
 
     base = [
@@ -122,50 +463,42 @@ def append_leave_request(member: dict, start_monday, weeks: int, reason="Persona
     ]
 
     if all(have.values()):
-        row = base + [
-            member.get("MemberName",""),
-            start_s,
-            end_s,
-            int(weeks),
-            reason,
-            description.strip()
-        ]
-        ws.append_row(row)
+        row = row_in_header_order(headers, {
+            "Timestamp": ts,
+            "MemberEmail": member.get("Email",""),
+            "MemberID": member.get("MemberID",""),
+            "RequestType": "Leave request",
+            "Status": "New",
+            "StudentName": member.get("MemberName",""),
+            "FromDate": start_s,
+            "ToDate": end_s,
+            "Weeks": int(weeks),
+            "LeaveReason": reason,
+            "LeaveDescription": description.strip(),
+        })
+        write_requests_rows([row])
     else:
         msg = f"Leave request | {member.get('MemberName','')} | {start_s} → {end_s} | {weeks} week(s) | Reason: {reason}"
         if description.strip():
             msg += f" | Desc: {description.strip()}"
-        ws.append_row(base[:4] + [msg] + base[5:])
-
-def _eq_str(a, b):
-    return str(a).strip().lower() == str(b).strip().lower()
+        write_requests_rows([base[:4] + [msg] + base[5:]])
 
 def append_contact_update(member: dict, update_type: str, update_name: str, *,
                           phone: str = "", email: str = "",
                           addr1: str = "", addr2: str = "", suburb: str = "", postcode: str = ""):
     """Append a structured Contact update to the Requests sheet.
     Works with your headers and only fills columns that exist."""
-    tz = pytz.timezone("Australia/Sydney")
-    ts = datetime.now(tz).strftime("%d-%m-%Y %H:%M:%S")
+    ts = datetime.now(SYDNEY_TZ).strftime(TS_FMT)
 
-    gc = get_gsheets_client()
-    ws = gc.open_by_key(st.secrets["sheets"]["requests_sheet_key"]).sheet1
-    headers = ws.row_values(1)
+    headers = get_requests_headers()
 
-    # Base required fields per your sheet
+    # Base required fields per your sheet (unlisted columns stay blank)
     row_map = {
         "Timestamp": ts,
         "MemberEmail": member.get("Email", ""),
         "MemberID": member.get("MemberID", ""),
         "RequestType": "Contact update",
-        "Message": "",  # we'll keep this empty if structured cols exist
-        "FromDate": "",
-        "ToDate": "",
-        "LeaveReason": "",
-        "LeaveDescription": "",
         "Status": "New",
-        "HandledBy": "",
-        "AdminNotes": "",
         # Structured contact fields (only set if present)
         "UpdateType": update_type,
         "UpdateName": update_name,
@@ -189,8 +522,7 @@ def append_contact_update(member: dict, update_type: str, update_name: str, *,
         row_map["Message"] = " | ".join(parts)
 
     # Emit values in the exact order of your sheet’s headers
-    values = [row_map.get(h, "") for h in headers]
-    ws.append_row(values)
+    write_requests_rows([row_in_header_order(headers, row_map)])
 
 # configure resend
 resend.api_key = st.secrets.get("RESEND_API_KEY")
@@ -201,7 +533,7 @@ def generate_code(length: int = 6) -> str:
 
 def generate_pin(length: int = 6) -> str:
     # 6-digit numeric PIN
-    return "".join(str(random.randint(0, 9)) for _ in range(length))
+    return generate_code(length)
 
 def send_reset_code(email: str, code: str):
     resend.Emails.send({
@@ -218,33 +550,376 @@ def send_reset_code(email: str, code: str):
     })
 
 def update_pin_for_email(email: str, new_pin: str):
-    """Updates PIN in the MEMBERS sheet for ALL rows matching the email (multi-student accounts)."""
-    gc = get_gsheets_client()
-    ws = gc.open_by_key(st.secrets["sheets"]["members_sheet_key"]).sheet1  # <-- make sure this exists in Secrets
-    rows = ws.get_all_values()
-    if not rows:
+    """Updates PIN in the MEMBERS sheet for ALL rows matching the email (multi-student accounts).
+    Sheets with a PIN_Hash column get a bcrypt hash and the plain PIN cell is blanked."""
+    ws = get_members_ws()
+    headers = ws.row_values(1)
+    if not headers:
         raise ValueError("Members sheet is empty.")
 
-    headers = rows[0]
-    try:
-        email_col = headers.index("Email") + 1
-        pin_col = headers.index("PIN") + 1
-    except ValueError:
-        raise ValueError("Members sheet must contain 'Email' and 'PIN' columns.")
+    if "Email" not in headers or not {"PIN", "PIN_Hash"} & set(headers):
+        raise ValueError("Members sheet must contain 'Email' and a 'PIN' or 'PIN_Hash' column.")
+    if "PIN_Hash" in headers:
+        writes = [(headers.index("PIN_Hash") + 1, pin_hash(new_pin))]
+        if "PIN" in headers:
+            writes.append((headers.index("PIN") + 1, ""))
+    else:
+        writes = [(headers.index("PIN") + 1, str(new_pin))]
 
-    target = email.strip().lower()
+    # Only the Email column is needed to locate the rows
+    emails = get_columns(ws, ["Email"], headers)["Email"]
+    target = norm_key(email)
     updated_any = False
 
     # Data starts from row 2 (1-indexed in Sheets)
-    for r_idx in range(2, len(rows) + 1):
-        row_email = (rows[r_idx - 1][email_col - 1] if len(rows[r_idx - 1]) >= email_col else "").strip().lower()
-        if row_email == target:
-            ws.update_cell(r_idx, pin_col, str(new_pin))
+    for r_idx, row_email in enumerate(emails, start=2):
+        if norm_key(row_email) == target:
+            for col, value in writes:
+                ws.update_cell(r_idx, col, value)
             updated_any = True
 
     if not updated_any:
         raise ValueError("No matching email found in Members sheet.")
 
+    # The members directory is cached for a day; drop it so the new PIN works straight away
+    load_members_index.clear()
+
+def fmt_weeks(x):
+    return f"{int(x)}" if float(x).is_integer() else f"{x}"
+
+@functools.lru_cache(maxsize=256)
+def balance_summary_html(allow: float, taken: float, bal: float, year: str, updated: str,
+                         free_allowance: int = 4) -> str:
+    """Usage bar, summary and year lines of the balance tab as one HTML block (one delta per
+    render); memoised per member figures."""
+    paid_allowance = max(0, allow - free_allowance)
+
+    free_used = min(taken, free_allowance)
+    paid_used = max(0, taken - free_allowance)
+
+    free_used_pct = (free_used / allow) * 100 if allow > 0 else 0
+    paid_used_pct = (paid_used / allow) * 100 if allow > 0 else 0
+
+    return f"""
+    <p><strong>Usage</strong></p>
+    <div style="background-color:#e0e0e0;border-radius:10px;height:24px;width:100%;overflow:hidden;display:flex">
+      <div style="background-color:#4CAF50;width:{free_used_pct}%;"></div>
+      <div style="background-color:#FF9800;width:{paid_used_pct}%;"></div>
+    </div>
+    <p style="font-size:0.85em;margin-top:4px">
+      <span style="color:#4CAF50">■</span> Free weeks used: {int(free_used)} / {int(free_allowance)} &nbsp; 
+      <span style="color:#FF9800">■</span> Paid weeks used: {int(paid_used)} / {int(paid_allowance)}
+    </p>
+    <div class='muted'>You have {bal:.0f} weeks remaining out of {allow:.0f} total.</div>
+    <div class='muted' style="margin:3rem 0 1.5rem">Year: {html.escape(year)} · Last updated: {html.escape(updated)}</div>
+    """
+
+# --- Tabs ---
+# Each tab is a fragment: its widgets rerun only that tab, not the whole script.
+@st.fragment
+def balance_tab(member):
+    # Numeric fields are already floats, see load_members_index
+    year    = member.get("LeaveYear","")
+    allow   = member.get("AnnualAllowance", 0.0)
+    taken   = member.get("LeaveTaken", 0.0)
+    bal     = member.get("LeaveBalance", 0.0)
+    updated = member.get("LastUpdated","")
+
+    st.info("Leave per calendar year")
+
+    # Metrics row
+    for col, (label, val) in zip(st.columns(3), [("Total", allow), ("Taken", taken), ("Remaining", bal)]):
+        col.metric(label, fmt_weeks(val))
+        col.caption("week(s)")
+
+    st.write("")
+
+    # --- Usage bar, summary line, year ---
+    st.markdown(balance_summary_html(allow, taken, bal, str(year), str(updated)), unsafe_allow_html=True)
+
+@st.fragment
+def leave_request_tab(member):
+    email = member.get("Email","")
+    email_key = norm_key(email)
+    member_id = norm_key(member.get("MemberID",""))
+    # Warm the overlap data while the form is being filled in
+    prefetch = prefetch_leave_periods(email_key, member_id)
+    st.subheader("Request Leave")
+
+    # --- Reminder about dojo policy ---
+    st.info(
+    "Leave requests must be submitted in writing with at least 14 days’ notice.  \nLeave is taken in full weekly blocks (minimum of one week), with a maximum of 8 weeks permitted per calendar year.  \nThe first 4 weeks of leave each calendar year are free of charge. Any approved leave beyond 4 weeks, up to the annual maximum of 8 weeks, will incur a \$10.00 per week processing fee.  \nLeave requests submitted with less than 14 days’ notice may incur a short-notice fee as follows: \$10.00 where notice is given between 8 and 13 days, and \$20.00 where notice is given 7 days or less prior to the requested start date. Suspension requests will not be accepted retrospectively.  \nStudents are not permitted to attend classes during an approved leave period.  \nAdditional leave may be considered in cases of serious illness or injury where a valid medical certificate is provided."
+    )
+
+    import datetime as _dt
+    def next_monday(d: _dt.date) -> _dt.date:
+        return d if d.weekday() == 0 else d + _dt.timedelta(days=(7 - d.weekday()))
+
+    today = _dt.date.today()
+    default_start = next_monday(today)
+
+    # After a successful submit: drop the form's state before its widgets are created again,
+    # so they come back with their defaults
+    if st.session_state.pop("lr_submitted", False):
+        for key in ("lr_start_monday", "lr_weeks", "lr_reason", "lr_desc"):
+            st.session_state.pop(key, None)
+        st.success("Leave request submitted. We’ll review it soon.")
+
+    start_sel = st.date_input(
+        "Start date (must be a Monday)",
+        value=default_start,
+        key="lr_start_monday"
+    )
+
+    weeks = st.number_input(
+        "Number of weeks",
+        min_value=1, step=1, value=1,
+        help="Leave is taken in whole weeks (Mon–Sun).",
+        key="lr_weeks"
+    )
+
+    reason = st.selectbox(
+        "Leave reason",
+        ["", "Personal", "Injury or Serious Illness"],
+        key="lr_reason"
+    )
+
+    if not reason:
+        st.info("⚠️ Please select a leave reason before submitting.")
+
+    if reason == "Injury or Serious Illness":
+        st.warning("A medical certificate stating nature of injury/illness and recovery time is required.  \nPlease send through to admin@example.com")
+
+
+    description = st.text_input(
+        "Short description",
+        max_chars=120,
+        key="lr_desc"
+    )
+
+    snapped_start = next_monday(start_sel)
+    if start_sel.weekday() != 0:
+        st.info(f"Start date will be adjusted to Monday: **{snapped_start.strftime('%d-%m-%Y')}**")
+
+    end_date = snapped_start + _dt.timedelta(days=7 * int(weeks) - 1)
+    st.caption(f"Requested period: **{snapped_start.strftime('%d-%m-%Y')} → {end_date.strftime('%d-%m-%Y')}** ({int(weeks)} week(s))")
+
+    if st.button("Submit leave request", type="primary", key="lr_submit"):
+            # --- Required field checks ---
+        if not snapped_start:
+            st.error("Please select a start date.")
+        elif not weeks or weeks < 1:
+            st.error("Please enter at least 1 week.")
+        elif not reason:
+            st.error("Please select a leave reason.")
+        elif not description or not description.strip():
+            st.error("Please enter a short description for your leave request.")
+        else:
+            try:
+                # --- Overlap validation: check existing leave requests for this member ---
+                prefetch.result()
+                periods = leave_periods(email_key, member_id, st.session_state.myreq_loaded)
+                conflict_rows = overlapping_leave(periods, snapped_start, end_date)
+                overlap_found = not conflict_rows.empty
+        
+                if overlap_found:
+                    # Show conflicts with friendly dates
+                    show = conflict_rows.copy()
+                    show["FromDate"] = show["_from"].dt.strftime("%d-%m-%Y")
+                    show["ToDate"]   = show["_to"].dt.strftime("%d-%m-%Y")
+                    st.error("This period overlaps an existing leave request. Please choose a different Monday or weeks.")
+                    st.dataframe(show[["FromDate", "ToDate", "Weeks", "Status"]] if "Weeks" in show.columns else show[["FromDate","ToDate","Status"]],
+                                 use_container_width=True, hide_index=True)
+                else:
+                    with st.spinner("Submitting leave request…"):
+                        append_leave_request(member, snapped_start, int(weeks), reason, description)
+                    st.session_state.lr_submitted = True
+            except Exception as e:
+                st.error(f"Could not submit leave request: {e}")
+            # Widget values can't be changed once created in this run; rerun to reset the form
+            if st.session_state.get("lr_submitted"):
+                st.rerun(scope="fragment")
+
+@st.fragment
+def contact_update_tab(member):
+    st.subheader("Update contact details")
+
+    # Choose detail to update
+    detail_type = st.selectbox(
+        "Which detail would you like to update?",
+        ["Phone number", "Address", "Email"],
+        key="upd_detail_type"
+    )
+
+    # Show the relevant field right away (reactive)
+    value = ""
+    if detail_type == "Phone number":
+        person_name = st.text_input("Name of person", key="upd_name")
+        value = st.text_input("New phone number", key="upd_phone")
+    elif detail_type == "Address":
+        person_name = st.text_input("Name of person", key="upd_name")
+        addr1 = st.text_input("Address Line 1", key="upd_addr1")
+        addr2 = st.text_input("Address Line 2", key="upd_addr2")
+        suburb = st.text_input("Suburb", key="upd_suburb")
+        postcode = st.text_input("Post Code", key="upd_postcode")
+    elif detail_type == "Email":
+        person_name = st.text_input("Name of person", key="upd_name")
+        value = st.text_input("New email address", key="upd_email")
+
+    # Submit button
+    if st.button("Submit update", type="primary", key="upd_submit"):
+        try:
+            if detail_type == "Phone number":
+                raw = value  # from st.text_input above
+                digits = PHONE_NON_DIGIT.sub("", raw)  # keep only numbers
+
+                if len(digits) == 10 and digits.startswith("0"):
+                    formatted = f"{digits[0:4]} {digits[4:7]} {digits[7:10]}"  # 0400 123 456
+                    append_contact_update(member, "Phone number", person_name, phone=formatted)
+                    st.success(f"Your contact update has been submitted: {formatted}")
+                else:
+                    st.error("Please enter a valid 10-digit mobile (e.g. 0400 123 456).")
+
+            elif detail_type == "Email":
+                append_contact_update(member, "Email", person_name, email=value.strip())
+                st.success("Your contact update has been submitted.")
+
+            elif detail_type == "Address":
+                append_contact_update(
+                    member, "Address", person_name,
+                    addr1=addr1, addr2=addr2, suburb=suburb, postcode=postcode
+                )
+                st.success("Your contact update has been submitted.")
+
+        except Exception as e:
+            st.error(f"Could not submit update: {e}")
+
+@st.fragment
+def my_requests_tab(member):
+    email = member.get("Email","")
+    st.subheader("My leave requests")
+
+    try:
+        # Only hit the Requests sheet once the member asks for it
+        mine = None
+        if not st.session_state.myreq_loaded:
+            if st.button("Load my requests", key="myreq_load"):
+                st.session_state.myreq_loaded = True
+                st.rerun()
+        else:
+            if st.button("Refresh", key="myreq_refresh"):
+                clear_requests_cache()
+            mine = load_my_requests(norm_key(email), norm_key(member.get("MemberID","")))
+
+        if mine is None:
+            pass
+        elif mine.empty:
+            st.info("No requests yet.")
+        
+        else:
+            rt = mine["_rt"]
+            is_pending = mine["_pending"]
+            is_leave   = rt == "leave request"
+            is_contact = rt == "contact update"
+        
+            # ---- Build counts for labels (one type x pending table) ----
+            counts = pd.crosstab(rt, is_pending).reindex(columns=[False, True], fill_value=0)
+            by_type = counts.reindex(["leave request", "contact update"], fill_value=0)
+            total_leave_all, total_contact_all = (int(n) for n in by_type.sum(axis=1))
+            total_leave_pending, total_contact_pending = (int(n) for n in by_type[True])
+            total_all_all      = len(mine)
+            total_all_pending  = int(counts[True].sum())
+
+        
+            # ---- Category picker (with counts) ----
+            cat_choice = st.radio(
+            "Category",
+                [
+                    f"Leave requests ({total_leave_pending}/{total_leave_all} pending)",
+                    f"Contact updates ({total_contact_pending}/{total_contact_all} pending)",
+                    f"All ({total_all_pending}/{total_all_all} pending)"
+                ],
+                horizontal=True,
+                key="myreq_category"
+            )
+
+        
+            # Apply category filter
+            view = mine.copy()
+            if cat_choice.startswith("Leave requests"):
+                view = view[is_leave]
+            elif cat_choice.startswith("Contact updates"):
+                view = view[is_contact]
+            # else: All → no extra filter
+
+            # Recompute counts for selected category
+            pending_view = is_pending.loc[view.index]
+            selected_total = len(view)
+            selected_pending = int(pending_view.sum())
+
+            # ---- Pending vs All toggle (with counters) ----
+            show_choice = st.radio(
+                "Show",
+                [f"Pending ({selected_pending})", f"All ({selected_total})"],
+                horizontal=True,
+                key="myreq_filter"
+            )
+            if show_choice.startswith("Pending"):
+                view = view[pending_view]
+
+            # Done filtering?
+            if view.empty:
+                st.info("No requests matching this filter.")
+            else:
+                # ---- Format dates DD-MM-YYYY ----
+                if "FromDate" in view.columns:
+                    view["FromDate"] = view["_from"].dt.strftime("%d-%m-%Y")
+                if "ToDate" in view.columns:
+                    view["ToDate"]   = view["_to"].dt.strftime("%d-%m-%Y")
+                if "_ts" in view.columns:
+                    view["Timestamp"] = view["_ts"].dt.strftime("%d-%m-%Y %H:%M")
+
+                # ---- Choose columns based on category ----
+                prefer_leave = [c for c in ["Timestamp","FromDate","ToDate","Weeks","LeaveReason","LeaveDescription","Status","AdminNotes"] if c in view.columns]
+                prefer_contact = [c for c in ["Timestamp","UpdateType","UpdateName","UpdatePhone","UpdateEmail","Addr1","Addr2","Suburb","PostCode","Status","AdminNotes"] if c in view.columns]
+                fallback = [c for c in ["Timestamp","RequestType","Message","Status","AdminNotes"] if c in view.columns]
+
+                if cat_choice.startswith("Leave requests") and prefer_leave:
+                    cols_order = prefer_leave
+                elif cat_choice.startswith("Contact updates") and prefer_contact:
+                    cols_order = prefer_contact
+                else:
+                    # "All" or when structured columns aren't present
+                    # Use a union that keeps things readable
+                    cols_union = prefer_leave + [c for c in prefer_contact if c not in prefer_leave]
+                    cols_order = cols_union if cols_union else fallback
+
+                st.data_editor(
+                    view[cols_order],
+                    use_container_width=True,
+                    hide_index=True,
+                    disabled=True,  # makes it read-only
+                    column_config={
+                        "Addr1": st.column_config.Column("Address Line 1", width="large"),
+                        "Addr2": st.column_config.Column("Address Line 2", width="large"),
+                        "Suburb": st.column_config.Column("Suburb", width="medium"),
+                        "PostCode": st.column_config.Column("Post Code", width="small"),
+                    }
+                )
+
+
+    except Exception as e:
+        st.error(f"Could not load requests: {e}")
+
+@st.fragment
+def dojo_info_tab():
+    st.subheader("Dojo info")
+    st.markdown("""
+- **Timetable:** See our latest class times on the noticeboard or website.
+- **Leave policy:** For more on our Membership Suspension Policy, please refer to the [Terms & Conditions](https://drive.google.com/file/d/1xdl9QdPZ7A8u20MnLsWNOmN1rqbF0qE4/view)
+- **Contact:** skwaverley@gmail.com · 0483 956 262
+    """)
+
 # --- UI ---
 # Heading + logout row
 col1, col2 = st.columns([6,1])  # wide column for heading, small one for button
@@ -253,6 +928,8 @@ with col1:
 with col2:
     if st.button("Logout"):
         st.session_state.member = None
+        st.session_state.myreq_loaded = False
+        st.session_state.students_by_name = {}
         st.rerun()
 
 # --- Login form (only show if not already logged in) ---
@@ -267,29 +944,32 @@ if st.session_state.member is None:
 
     if submitted:
         try:
-            df = load_members_df()
+            member_cols, by_email, verify = load_members_index()
             required_cols = {"MemberID","MemberName","Email","LeaveYear","AnnualAllowance","LeaveTaken","LeaveBalance","LastUpdated"}
-            missing = [c for c in required_cols if c not in df.columns]
+            missing = [c for c in required_cols if c not in member_cols]
             if missing:
                 st.error(f"Your Members sheet is missing columns: {', '.join(missing)}")
+            elif verify is None:
+                st.error("Your Members sheet needs a PIN or PIN_Hash column.")
             else:
                 # Find all rows that match this email + PIN
-                matches = df[
-                    (df["Email"].str.strip().str.lower() == email.strip().lower())
-                    & (df["PIN"].astype(str) == pin)
-                ]
-                
-                if not matches.empty:
-                    if len(matches) > 1:
-                        # More than one student under this account → let user pick
-                        student_names = matches["MemberName"].tolist()
-                        chosen = st.selectbox("Select a student", student_names, key="student_picker")
-                        member_row = matches[matches["MemberName"] == chosen].iloc[0].to_dict()
-                    else:
-                        # Just one student
-                        member_row = matches.iloc[0].to_dict()
+                matches = [r for r in members_for_email(by_email, email) if verify(pin, r)]
                 
-                    st.session_state.member = member_row
+                if matches:
+                    # First login since the bcrypt switch: re-store the PIN as a bcrypt hash.
+                    # Only when every row under the email matched, since the write covers them all.
+                    if any(needs_rehash(r) for r in matches) and len(matches) == len(members_for_email(by_email, email)):
+                        # Re-store exactly what was verified: hashed rows matched the PIN as
+                        # typed, plain rows the trimmed PIN
+                        verified = pin if str(matches[0].get("PIN_Hash","")).strip() else (pin or "").strip()
+                        try:
+                            update_pin_for_email(email, verified)
+                        except Exception:
+                            pass  # the legacy hash still works; try again next login
+                    # Keep every student under this account; the logged-in view offers a picker
+                    students = [member_session_record(r) for r in matches]
+                    st.session_state.students_by_name = {r["MemberName"]: r for r in students}
+                    st.session_state.member = students[0]
                     st.success("Found your record.")
                     st.rerun()
                 else:
@@ -333,7 +1013,7 @@ if st.session_state.member is None:
                             code = generate_code(6)
         
                             st.session_state.reset_code = code
-                            st.session_state.reset_email_pending = reset_email.strip().lower()
+                            st.session_state.reset_email_pending = norm_key(reset_email)
                             st.session_state.reset_code_expiry = datetime.now() + timedelta(minutes=10)
         
                             send_reset_code(reset_email, code)
@@ -357,7 +1037,7 @@ if st.session_state.member is None:
                     if st.button("Verify code"):
                         if datetime.now() > st.session_state.reset_code_expiry:
                             st.error("Code expired. Please request a new one.")
-                        elif entered_code == st.session_state.reset_code:
+                        elif hmac.compare_digest((entered_code or "").strip().encode(), str(st.session_state.reset_code).encode()):
                             st.session_state.reset_verified = True
                             st.success("Email verified.")
                             st.rerun()
@@ -390,30 +1070,30 @@ if st.session_state.member is None:
 
 else:
     member = st.session_state.member
+
+    # More than one student under this account → let user pick (no sheet reload)
+    students_by_name = st.session_state.students_by_name
+    if len(students_by_name) > 1:
+        student_names = list(students_by_name)
+        chosen = st.selectbox(
+            "Select a student", student_names,
+            index=student_names.index(member["MemberName"]) if member["MemberName"] in students_by_name else 0,
+            key="student_picker"
+        )
+        member = students_by_name[chosen]
+        st.session_state.member = member
                 
-    # Pull fields
-    def as_float(x, default=0):
-        try:
-            return float(x)
-        except Exception:
-            return default
-    
-    def pct(a, b):
-        try:
-            a = float(a); b = float(b)
-            return 0 if b <= 0 else max(0, min(100, (a / b) * 100))
-        except Exception:
-            return 0
-    
     name    = member.get("MemberName","")
-    year    = member.get("LeaveYear","")
-    allow   = as_float(member.get("AnnualAllowance", 0))
-    taken   = as_float(member.get("LeaveTaken", 0))
-    bal     = as_float(member.get("LeaveBalance", 0))
-    updated = member.get("LastUpdated","")
     email   = member.get("Email","")
     
     st.markdown(f"**{name}**  ·  {email}")
+
+    # Admins can pull sheet edits (members, Requests columns) in before the caches expire
+    if norm_key(email) in ADMIN_EMAILS:
+        if st.button("Refresh directory", key="admin_refresh_members"):
+            load_members_index.clear()
+            get_requests_headers.clear()
+            st.rerun()
     st.write("")  # spacer
 
     # --- Navigation (radio buttons that look like tabs) ---
@@ -425,372 +1105,12 @@ else:
     )
 
     if nav == "My balance":
-
-        st.info("Leave per calendar year")
-
-        # Card layout with metrics
-        c1, c2, c3 = st.columns([1,1,1])
-        with c1:
-            st.markdown("<div class='card'><div class='title'>Total</div>", unsafe_allow_html=True)
-            st.metric(label="", value=f"{int(allow) if isinstance(allow, float) and allow.is_integer() else allow}")
-            st.caption("week(s)")
-            st.markdown("</div>", unsafe_allow_html=True)
-        with c2:
-            st.markdown("<div class='card'><div class='title'>Taken</div>", unsafe_allow_html=True)
-            st.metric(label="", value=f"{int(taken) if isinstance(taken, float) and taken.is_integer() else taken}")
-            st.caption("week(s)")
-            st.markdown("</div>", unsafe_allow_html=True)
-        with c3:
-            st.markdown("<div class='card'><div class='title'>Remaining</div>", unsafe_allow_html=True)
-            st.metric(label="", value=f"{int(bal) if isinstance(bal, float) and bal.is_integer() else bal}")
-            st.caption("week(s)")
-            st.markdown("</div>", unsafe_allow_html=True)
-
-        st.write("")
-
-        # --- Calculate free vs paid usage ---
-        free_allowance = 4
-        paid_allowance = max(0, allow - free_allowance)
-        
-        free_used = min(taken, free_allowance)
-        paid_used = max(0, taken - free_allowance)
-        
-        free_used_pct = (free_used / allow) * 100 if allow > 0 else 0
-        paid_used_pct = (paid_used / allow) * 100 if allow > 0 else 0
-        
-        # --- Custom progress bar ---
-        st.markdown("**Usage**", unsafe_allow_html=True)
-        
-        bar_html = f"""
-        <div style="background-color:#e0e0e0;border-radius:10px;height:24px;width:100%;overflow:hidden;display:flex">
-          <div style="background-color:#4CAF50;width:{free_used_pct}%;"></div>
-          <div style="background-color:#FF9800;width:{paid_used_pct}%;"></div>
-        </div>
-        <p style="font-size:0.85em;margin-top:4px">
-          <span style="color:#4CAF50">■</span> Free weeks used: {int(free_used)} / {int(free_allowance)} &nbsp; 
-          <span style="color:#FF9800">■</span> Paid weeks used: {int(paid_used)} / {int(paid_allowance)}
-        </p>
-        """
-        
-        st.markdown(bar_html, unsafe_allow_html=True)
-        
-        # --- Summary line ---
-        st.markdown(
-            f"<div class='muted'>You have {bal:.0f} weeks remaining out of {allow:.0f} total.</div>",
-            unsafe_allow_html=True
-        )
-
-        st.write("")  # spacer
-        st.write("")  # spacer
-        st.markdown(f"<div class='muted'>Year: {year} · Last updated: {updated}</div>", unsafe_allow_html=True)
-        st.write("")  # spacer
-
+        balance_tab(member)
     elif nav == "Leave request":
-        st.subheader("Request Leave")
-
-        # --- Reminder about dojo policy ---
-        st.info(
-        "Leave requests must be submitted in writing with at least 14 days’ notice.  \nLeave is taken in full weekly blocks (minimum of one week), with a maximum of 8 weeks permitted per calendar year.  \nThe first 4 weeks of leave each calendar year are free of charge. Any approved leave beyond 4 weeks, up to the annual maximum of 8 weeks, will incur a \$10.00 per week processing fee.  \nLeave requests submitted with less than 14 days’ notice may incur a short-notice fee as follows: \$10.00 where notice is given between 8 and 13 days, and \$20.00 where notice is given 7 days or less prior to the requested start date. Suspension requests will not be accepted retrospectively.  \nStudents are not permitted to attend classes during an approved leave period.  \nAdditional leave may be considered in cases of serious illness or injury where a valid medical certificate is provided."
-    )
-    
-        import datetime as _dt
-        def next_monday(d: _dt.date) -> _dt.date:
-            return d if d.weekday() == 0 else d + _dt.timedelta(days=(7 - d.weekday()))
-    
-        today = _dt.date.today()
-        default_start = next_monday(today)
-        start_sel = st.date_input(
-            "Start date (must be a Monday)",
-            value=default_start,
-            key="lr_start_monday"
-        )
-    
-        weeks = st.number_input(
-            "Number of weeks",
-            min_value=1, step=1, value=1,
-            help="Leave is taken in whole weeks (Mon–Sun).",
-            key="lr_weeks"
-        )
-    
-        reason = st.selectbox(
-            "Leave reason",
-            ["", "Personal", "Injury or Serious Illness"],
-            key="lr_reason"
-        )
-
-        if not reason:
-            st.info("⚠️ Please select a leave reason before submitting.")
-
-        if reason == "Injury or Serious Illness":
-            st.warning("A medical certificate stating nature of injury/illness and recovery time is required.  \nPlease send through to admin@example.com")
-
-    
-        description = st.text_input(
-            "Short description",
-            max_chars=120,
-            key="lr_desc"
-        )
-    
-        snapped_start = next_monday(start_sel)
-        if start_sel.weekday() != 0:
-            st.info(f"Start date will be adjusted to Monday: **{snapped_start.strftime('%d-%m-%Y')}**")
-    
-        end_date = snapped_start + _dt.timedelta(days=7 * int(weeks) - 1)
-        st.caption(f"Requested period: **{snapped_start.strftime('%d-%m-%Y')} → {end_date.strftime('%d-%m-%Y')}** ({int(weeks)} week(s))")
-    
-        if st.button("Submit leave request", type="primary", key="lr_submit"):
-                # --- Required field checks ---
-            if not snapped_start:
-                st.error("Please select a start date.")
-            elif not weeks or weeks < 1:
-                st.error("Please enter at least 1 week.")
-            elif not reason:
-                st.error("Please select a leave reason.")
-            elif not description or not description.strip():
-                st.error("Please enter a short description for your leave request.")
-            else:
-                try:
-                    # --- Overlap validation: check existing leave requests for this member ---
-                    gc = get_gsheets_client()
-                    r_ws = gc.open_by_key(st.secrets["sheets"]["requests_sheet_key"]).sheet1
-                    r_df = pd.DataFrame(r_ws.get_all_records())
-            
-                    overlap_found = False
-                    conflict_rows = pd.DataFrame()
-            
-                    if not r_df.empty:
-                        mine = r_df[r_df["MemberEmail"].str.strip().str.lower() == str(email).strip().lower()]
-                        if "MemberID" in mine.columns:
-                            mine = mine[mine["MemberID"].astype(str).str.strip().str.lower() == str(member.get("MemberID","")).strip().lower()]
-                            if not mine.empty:
-                                # Only leave requests
-                                if "RequestType" in mine.columns:
-                                    mine = mine[mine["RequestType"].str.strip().str.lower() == "leave request"]
-            
-                        # Try parse FromDate/ToDate (DD-MM-YYYY or other); fall back to message parsing if needed
-                        if "FromDate" in mine.columns and "ToDate" in mine.columns:
-                            start_new = snapped_start
-                            end_new = end_date
-        
-                            # Parse with dayfirst for DD-MM-YYYY
-                            mine["_from"] = pd.to_datetime(mine["FromDate"], errors="coerce", dayfirst=True)
-                            mine["_to"]   = pd.to_datetime(mine["ToDate"],   errors="coerce", dayfirst=True)
-        
-                            # Any overlap if: existing_from <= new_end AND existing_to >= new_start
-                            conflict_mask = (mine["_from"].notna() & mine["_to"].notna() &
-                                             (mine["_from"].dt.date <= end_new) &
-                                             (mine["_to"].dt.date   >= start_new))
-                            conflict_rows = mine[conflict_mask]
-                            overlap_found = not conflict_rows.empty
-            
-                    if overlap_found:
-                        # Show conflicts with friendly dates
-                        show = conflict_rows.copy()
-                        show["FromDate"] = pd.to_datetime(show["_from"]).dt.strftime("%d-%m-%Y")
-                        show["ToDate"]   = pd.to_datetime(show["_to"]).dt.strftime("%d-%m-%Y")
-                        st.error("This period overlaps an existing leave request. Please choose a different Monday or weeks.")
-                        st.dataframe(show[["FromDate", "ToDate", "Weeks", "Status"]] if "Weeks" in show.columns else show[["FromDate","ToDate","Status"]],
-                                     use_container_width=True, hide_index=True)
-                    
-                        append_leave_request(member, snapped_start, int(weeks), reason, description)
-                        st.success("Leave request submitted. We’ll review it soon.")
-                        st.session_state.lr_weeks = 1
-                        st.session_state.lr_desc = ""
-                        st.session_state.lr_reason = "Personal"
-                        st.session_state.lr_start_monday = next_monday(_dt.date.today())
-                except Exception as e:
-                    st.error(f"Could not submit leave request: {e}")
-
-
+        leave_request_tab(member)
     elif nav == "Update contact details":
-        st.subheader("Update contact details")
-    
-        # Choose detail to update
-        detail_type = st.selectbox(
-            "Which detail would you like to update?",
-            ["Phone number", "Address", "Email"],
-            key="upd_detail_type"
-        )
-    
-        # Show the relevant field right away (reactive)
-        value = ""
-        if detail_type == "Phone number":
-            person_name = st.text_input("Name of person", key="upd_name")
-            value = st.text_input("New phone number", key="upd_phone")
-        elif detail_type == "Address":
-            addr1 = st.text_input("Address Line 1", key="upd_addr1")
-            addr2 = st.text_input("Address Line 2", key="upd_addr2")
-            suburb = st.text_input("Suburb", key="upd_suburb")
-            postcode = st.text_input("Post Code", key="upd_postcode")
-        elif detail_type == "Email":
-            person_name = st.text_input("Name of person", key="upd_name")
-            value = st.text_input("New email address", key="upd_email")
-    
-    
-            # Submit button
-            if st.button("Submit update", type="primary", key="upd_submit"):
-                try:
-                    if detail_type == "Phone number":
-                        import re
-                        raw = phone  # from st.text_input above
-                        digits = re.sub(r"\D", "", raw)  # keep only numbers
-        
-                        if len(digits) == 10 and digits.startswith("0"):
-                            formatted = f"{digits[0:4]} {digits[4:7]} {digits[7:10]}"  # 0400 123 456
-                            append_contact_update(member, "Phone number", person_name, phone=formatted)
-                            st.success(f"Your contact update has been submitted: {formatted}")
-                        else:
-                            st.error("Please enter a valid 10-digit mobile (e.g. 0400 123 456).")
-        
-                    elif detail_type == "Email":
-                        append_contact_update(member, "Email", person_name, email=new_email)
-                        st.success("Your contact update has been submitted.")
-        
-                    elif detail_type == "Address":
-                        append_contact_update(
-                            member, "Address", person_name,
-                            addr1=addr1, addr2=addr2, suburb=suburb, postcode=postcode
-                        )
-                        st.success("Your contact update has been submitted.")
-        
-                except Exception as e:
-                    st.error(f"Could not submit update: {e}")
-
+        contact_update_tab(member)
     elif nav == "My requests":
-        st.subheader("My leave requests")
-    
-        try:
-            gc = get_gsheets_client()
-            r_ws = gc.open_by_key(st.secrets["sheets"]["requests_sheet_key"]).sheet1
-            r_df = pd.DataFrame(r_ws.get_all_records())
-    
-            if r_df.empty:
-                st.info("No requests yet.")
-            else:
-                
-                # Filter to this member (email + MemberID)
-                mine = r_df[
-                    r_df.get("MemberEmail", "").astype(str).str.strip().str.lower() == str(email).strip().lower()
-                ]
-                if "MemberID" in mine.columns:
-                    mine = mine[mine["MemberID"].astype(str).str.strip().str.lower() == str(member.get("MemberID","")).strip().lower()]
-                
-                    if mine.empty:
-                        st.info("No requests yet.")
-                    
-                    else:
-                        # Normalise RequestType for counting / filtering
-                        rt = mine.get("RequestType", "").astype(str).str.strip().str.lower()
-                        is_leave   = rt == "leave request"
-                        is_contact = rt == "contact update"
-                    
-                        # ---- Build counts for labels ----
-                        total_leave_all    = int(is_leave.sum())
-                        total_contact_all  = int(is_contact.sum())
-                        total_all_all      = len(mine)
-        
-                        pending_values = {"new","pending","in review","in-progress","submitted"}
-                        status_lower = mine.get("Status","").astype(str).str.strip().str.lower()
-                        total_leave_pending   = int((is_leave   & status_lower.isin(pending_values)).sum())
-                        total_contact_pending = int((is_contact & status_lower.isin(pending_values)).sum())
-                        total_all_pending     = int(status_lower.isin(pending_values).sum())
-    
-                    
-                        # ---- Category picker (with counts) ----
-                        cat_choice = st.radio(
-                        "Category",
-                            [
-                                f"Leave requests ({total_leave_pending}/{total_leave_all} pending)",
-                                f"Contact updates ({total_contact_pending}/{total_contact_all} pending)",
-                                f"All ({total_all_pending}/{total_all_all} pending)"
-                            ],
-                            horizontal=True,
-                            key="myreq_category"
-                        )
-    
-                    
-                        # Apply category filter
-                        view = mine.copy()
-                        if cat_choice.startswith("Leave requests"):
-                            view = view[is_leave]
-                        elif cat_choice.startswith("Contact updates"):
-                            view = view[is_contact]
-                        # else: All → no extra filter
-    
-                        # Recompute counts for selected category
-                        status_lower_view = view.get("Status","").astype(str).str.strip().str.lower()
-                        selected_total = len(view)
-                        selected_pending = int(status_lower_view.isin(pending_values).sum())
-    
-                        # ---- Pending vs All toggle (with counters) ----
-                        show_choice = st.radio(
-                            "Show",
-                            [f"Pending ({selected_pending})", f"All ({selected_total})"],
-                            horizontal=True,
-                            key="myreq_filter"
-                        )
-                        if show_choice.startswith("Pending"):
-                            view = view[status_lower_view.isin(pending_values)]
-    
-                        # Done filtering?
-                        if view.empty:
-                            st.info("No requests matching this filter.")
-                        else:
-                            # ---- Format dates DD-MM-YYYY ----
-                            if "FromDate" in view.columns:
-                                view["FromDate"] = pd.to_datetime(view["FromDate"], errors="coerce", dayfirst=True).dt.strftime("%d-%m-%Y")
-                            if "ToDate" in view.columns:
-                                view["ToDate"]   = pd.to_datetime(view["ToDate"],   errors="coerce", dayfirst=True).dt.strftime("%d-%m-%Y")
-                            if "Timestamp" in view.columns:
-                                ts_parsed = pd.to_datetime(view["Timestamp"], errors="coerce", dayfirst=True)
-                                view["Timestamp"] = ts_parsed.dt.strftime("%d-%m-%Y %H:%M")
-    
-                            # ---- Choose columns based on category ----
-                            prefer_leave = [c for c in ["Timestamp","FromDate","ToDate","Weeks","LeaveReason","LeaveDescription","Status","AdminNotes"] if c in view.columns]
-                            prefer_contact = [c for c in ["Timestamp","UpdateType","UpdateName","UpdatePhone","UpdateEmail","Addr1","Addr2","Suburb","PostCode","Status","AdminNotes"] if c in view.columns]
-                            fallback = [c for c in ["Timestamp","RequestType","Message","Status","AdminNotes"] if c in view.columns]
-        
-                            if cat_choice.startswith("Leave requests") and prefer_leave:
-                                cols_order = prefer_leave
-                            elif cat_choice.startswith("Contact updates") and prefer_contact:
-                                cols_order = prefer_contact
-                            else:
-                                # "All" or when structured columns aren't present
-                                # Use a union that keeps things readable
-                                cols_union = prefer_leave + [c for c in prefer_contact if c not in prefer_leave]
-                                cols_order = cols_union if cols_union else fallback
-        
-                            # ---- Sort newest first if we have Timestamp ----
-                            if "Timestamp" in view.columns:
-                                view["_ts"] = pd.to_datetime(view["Timestamp"], errors="coerce", dayfirst=True)
-                                view = view.sort_values("_ts", ascending=False).drop(columns=["_ts"], errors="ignore")
-        
-                            st.data_editor(
-                                view[cols_order],
-                                use_container_width=True,
-                                hide_index=True,
-                                disabled=True,  # makes it read-only
-                                column_config={
-                                    "Addr1": st.column_config.Column("Address Line 1", width="large"),
-                                    "Addr2": st.column_config.Column("Address Line 2", width="large"),
-                                    "Suburb": st.column_config.Column("Suburb", width="medium"),
-                                    "PostCode": st.column_config.Column("Post Code", width="small"),
-                                }
-                            )
-
-
-        except Exception as e:
-            st.error(f"Could not load requests: {e}")
-
-
+        my_requests_tab(member)
     elif nav == "Dojo info":
-        st.subheader("Dojo info")
-        st.markdown("""
-- **Timetable:** See our latest class times on the noticeboard or website.
-- **Leave policy:** For more on our Membership Suspension Policy, please refer to the [Terms & Conditions](https://drive.google.com/file/d/1xdl9QdPZ7A8u20MnLsWNOmN1rqbF0qE4/view)
-- **Contact:** skwaverley@gmail.com · 0483 956 262
-        """)
-
-    # ---- logged-out view ----
-    else:
-        st.info("Enter your email and PIN to view your balance.")
+        dojo_info_tab()
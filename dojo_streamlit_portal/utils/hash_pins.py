@@ -1,22 +1,184 @@
+import bcrypt
+import functools
 import hashlib
+import os
+import queue
+import sys
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import nullcontext
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import argparse
 
+CHUNK_BYTES = 4 << 20  # ~50k member rows
+BCRYPT_ROUNDS = 12  # same cost as the portal's PIN resets
+BCRYPT_MAX_BYTES = 72  # longest input bcrypt hashes
+PIN_PATTERN = r"\d{4,8}"  # what the login form asks for
+
+def salted_hasher(salt: str = ""):
+    """SHA-256 state with the salt already absorbed; hash each PIN on a .copy() of it."""
+    h = hashlib.sha256()
+    h.update(salt.encode())
+    return h
+
 def pin_hash(pin: str, salt: str = "") -> str:
-    return hashlib.sha256((salt + str(pin)).encode()).hexdigest()
+    # sha256(salt + pin), fed in two updates rather than via a concatenated string
+    h = salted_hasher(salt)
+    h.update(str(pin).encode())
+    return h.hexdigest()
+
+def hash_column(pins, salt: str = "") -> list:
+    """pin_hash for a whole column of str PINs in one loop. The salt is hashed once; each
+    distinct PIN only costs a state copy plus its own bytes, and repeats reuse its digest.
+    A blank PIN stays blank rather than becoming a hash that matches an empty login."""
+    copy = salted_hasher(salt).copy
+    digests = {"": ""}
+    out = [None] * len(pins)
+    for i, p in enumerate(pins):
+        d = digests.get(p)
+        if d is None:
+            h = copy()
+            h.update(p.encode())
+            d = digests[p] = h.hexdigest()
+        out[i] = d
+    return out
+
+def bcrypt_column(pins, rounds: int = BCRYPT_ROUNDS) -> list:
+    """bcrypt hashes (own salt per PIN, no --salt needed), as the portal stores on PIN reset.
+    PINs over BCRYPT_MAX_BYTES get an empty hash: bcrypt>=4.1 raises on them, older ones truncate."""
+    return [bcrypt.hashpw(b, bcrypt.gensalt(rounds=rounds)).decode() if b and len(b) <= BCRYPT_MAX_BYTES else ""
+            for b in (p.encode() for p in pins)]
+
+def _read_ahead(chunks, depth: int = 2):
+    """Yield from chunks while a background thread reads up to depth chunks ahead."""
+    q = queue.Queue(maxsize=depth)
+    end = object()
+
+    def reader():
+        try:
+            for c in chunks:
+                q.put(c)
+            q.put(end)
+        except BaseException as e:
+            q.put(e)
+
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        item = q.get()
+        if item is end:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+def _read_chunks(infile, columns, block_size: int = CHUNK_BYTES):
+    """Stream infile through Arrow's C++ CSV reader as pandas chunks. Every
+    column is read as text, so values (PINs with leading zeros included) pass through unchanged.
+    Quoted cells may span lines (multi-line notes or addresses), as pandas allowed."""
+    reader = pacsv.open_csv(
+        infile,
+        read_options=pacsv.ReadOptions(block_size=block_size),
+        parse_options=pacsv.ParseOptions(newlines_in_values=True),
+        convert_options=pacsv.ConvertOptions(column_types={c: pa.string() for c in columns}),
+    )
+    for batch in reader:
+        yield batch.to_pandas()
+
+def hash_csv(infile, outfile, salt: str = "", block_size: int = CHUNK_BYTES, workers: int = None,
+             scheme: str = "sha256", keep_pin: bool = False):
+    """Copy infile to outfile with PIN replaced by PIN_Hash (or added beside it with keep_pin).
+    Output goes to a temp file next to outfile and is renamed over it only once every chunk is
+    written, so a failed run never leaves a partial members file."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outfile)), suffix=".csv.tmp")
+    os.close(fd)
+    try:
+        _hash_csv(infile, tmp, salt, block_size, workers, scheme, keep_pin)
+        os.replace(tmp, outfile)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def _hash_csv(infile, outfile, salt, block_size, workers, scheme, keep_pin):
+    """hash_csv's body, a chunk at a time. Chunks are parsed ahead, each split across `workers`
+    processes, and written back in input order. By default only bcrypt uses processes; SHA-256
+    is cheaper than shipping the PINs to another process, so it hashes in-process."""
+    if workers is None:
+        workers = (os.cpu_count() or 1) if scheme == "bcrypt" else 1
+    columns = pd.read_csv(infile, nrows=0).columns
+    if "PIN" not in columns:
+        raise SystemExit("No 'PIN' column found.")
+    hasher = bcrypt_column if scheme == "bcrypt" else functools.partial(hash_column, salt=salt)
+    first = True
+    seen = 0  # rows before the current chunk, for row numbers in warnings
+    in_flight = deque()
+
+    def submit(pins):
+        if pool is None:
+            done = Future()
+            done.set_result(hasher(pins))
+            return [done]
+        step = max(1, -(-len(pins) // workers))
+        return [pool.submit(hasher, pins[i:i + step]) for i in range(0, len(pins), step)]
+
+    def write_oldest():
+        nonlocal first
+        chunk, shards = in_flight.popleft()
+        hashed = [d for f in shards for d in f.result()]
+        if keep_pin:
+            chunk["PIN_Hash"] = hashed
+        else:
+            # Overwrite PIN in place so plain and hashed columns are never both held
+            chunk["PIN"] = hashed
+            chunk = chunk.drop(columns=["PIN_Hash"], errors="ignore").rename(columns={"PIN": "PIN_Hash"})
+        chunk.to_csv(outfile, mode="w" if first else "a", header=first, index=False)
+        first = False
+
+    with (ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext()) as pool:
+        for chunk in _read_ahead(_read_chunks(infile, columns, block_size)):
+            # PIN is read as text (see _read_chunks), so it is checked once here and the
+            # hashers take the strings as they are
+            pins = chunk["PIN"]
+            bad = ~(pins.eq("") | pins.str.fullmatch(PIN_PATTERN))
+            if bad.any():
+                print(f"Warning: {int(bad.sum())} PIN(s) are not 4-8 digits; hashed as given.", file=sys.stderr)
+            if scheme == "bcrypt":
+                too_long = pins.str.encode("utf-8").str.len() > BCRYPT_MAX_BYTES
+                if too_long.any():
+                    # Data rows, 1-based; not file lines, as quoted cells may span several
+                    rows = ", ".join(str(seen + i + 1) for i in too_long.to_numpy().nonzero()[0])
+                    print(f"Warning: PIN over {BCRYPT_MAX_BYTES} bytes in row(s) {rows}; left PIN_Hash empty.",
+                          file=sys.stderr)
+            seen += len(chunk)
+            in_flight.append((chunk, submit(pins.tolist())))
+            if len(in_flight) > 1:
+                write_oldest()
+        while in_flight:
+            write_oldest()
+    if first:  # header-only input
+        if keep_pin:
+            out_columns = [*dict.fromkeys([*columns, "PIN_Hash"])]
+        else:
+            out_columns = ["PIN_Hash" if c == "PIN" else c for c in columns if c != "PIN_Hash"]
+        pd.DataFrame(columns=out_columns).to_csv(outfile, index=False)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Hash PINs from Members CSV and write PIN_Hash column")
     parser.add_argument("--infile", required=True, help="Path to members CSV with PIN column")
     parser.add_argument("--outfile", required=True, help="Where to write the output CSV")
     parser.add_argument("--salt", default="", help="Optional salt string (should match secrets.security.pin_salt)")
+    parser.add_argument("--scheme", choices=["sha256", "bcrypt"], default="sha256",
+                        help="sha256: salted SHA-256 (legacy); bcrypt: what the portal itself stores, slower to make")
+    parser.add_argument("--keep-pin", action="store_true", help="Keep the plain PIN column next to PIN_Hash")
+    parser.add_argument("--block-size", type=int, default=CHUNK_BYTES, help="Bytes of CSV read, hashed and written per chunk")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Processes hashing each chunk in parallel (default: all cores for bcrypt, 1 for sha256)")
     args = parser.parse_args()
+    if args.salt and args.scheme == "bcrypt":
+        parser.error("--salt only applies to --scheme sha256; bcrypt salts each PIN itself")
 
-    df = pd.read_csv(args.infile)
-    if "PIN" not in df.columns:
-        raise SystemExit("No 'PIN' column found.")
-    df["PIN_Hash"] = df["PIN"].apply(lambda x: pin_hash(x, args.salt))
-    # Remove the plain PIN if you want:
-    # df = df.drop(columns=["PIN"])
-    df.to_csv(args.outfile, index=False)
+    hash_csv(args.infile, args.outfile, args.salt, args.block_size, args.workers, args.scheme, args.keep_pin)
     print(f"Wrote {args.outfile}")